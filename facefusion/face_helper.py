@@ -99,17 +99,34 @@ def warp_face_by_translation(temp_vision_frame : VisionFrame, translation : Tran
 
 
 def paste_back(temp_vision_frame : VisionFrame, crop_vision_frame : VisionFrame, crop_mask : Mask, affine_matrix : Matrix) -> VisionFrame:
-	inverse_matrix = cv2.invertAffineTransform(affine_matrix)
-	temp_size = temp_vision_frame.shape[:2][::-1]
-	inverse_mask = cv2.warpAffine(crop_mask, inverse_matrix, temp_size).clip(0, 1)
-	inverse_vision_frame = cv2.warpAffine(crop_vision_frame, inverse_matrix, temp_size, borderMode = cv2.BORDER_REPLICATE)
+	paste_bounding_box, paste_matrix = calc_paste_area(temp_vision_frame, crop_vision_frame, affine_matrix)
+	x1, y1, x2, y2 = paste_bounding_box
 	paste_vision_frame = temp_vision_frame.copy()
-	paste_vision_frame[:, :, 0] = inverse_mask * inverse_vision_frame[:, :, 0] + (1 - inverse_mask) * temp_vision_frame[:, :, 0]
-	paste_vision_frame[:, :, 1] = inverse_mask * inverse_vision_frame[:, :, 1] + (1 - inverse_mask) * temp_vision_frame[:, :, 1]
-	paste_vision_frame[:, :, 2] = inverse_mask * inverse_vision_frame[:, :, 2] + (1 - inverse_mask) * temp_vision_frame[:, :, 2]
+
+	if x2 > x1 and y2 > y1:
+		paste_size = (x2 - x1, y2 - y1)
+		inverse_mask = cv2.warpAffine(crop_mask, paste_matrix, paste_size).clip(0, 1)
+		inverse_mask = numpy.expand_dims(inverse_mask, axis = -1)
+		inverse_vision_frame = cv2.warpAffine(crop_vision_frame, paste_matrix, paste_size, borderMode = cv2.BORDER_REPLICATE)
+		area_vision_frame = temp_vision_frame[y1:y2, x1:x2]
+		paste_vision_frame[y1:y2, x1:x2] = inverse_mask * inverse_vision_frame + (1 - inverse_mask) * area_vision_frame
 	return paste_vision_frame
 
 
+def calc_paste_area(temp_vision_frame : VisionFrame, crop_vision_frame : VisionFrame, affine_matrix : Matrix) -> Tuple[BoundingBox, Matrix]:
+	temp_height, temp_width = temp_vision_frame.shape[:2]
+	crop_height, crop_width = crop_vision_frame.shape[:2]
+	inverse_matrix = cv2.invertAffineTransform(affine_matrix)
+	crop_bounding_box = numpy.array([ -1, -1, crop_width, crop_height ])
+	paste_bounding_box = transform_bounding_box(crop_bounding_box, inverse_matrix)
+	x1, y1 = numpy.clip(numpy.floor(paste_bounding_box[:2]), 0, [ temp_width, temp_height ]).astype(int)
+	x2, y2 = numpy.clip(numpy.ceil(paste_bounding_box[2:]) + 1, 0, [ temp_width, temp_height ]).astype(int)
+	paste_matrix = inverse_matrix.copy()
+	paste_matrix[0, 2] -= x1
+	paste_matrix[1, 2] -= y1
+	return numpy.array([ x1, y1, x2, y2 ]), paste_matrix
+
+
 @lru_cache(maxsize = None)
 def create_static_anchors(feature_stride : int, anchor_total : int, stride_height : int, stride_width : int) -> Anchors:
 	y, x = numpy.mgrid[:stride_height, :stride_width][::-1]
@@ -1,5 +1,6 @@
 import os
 import zlib
+from functools import lru_cache
 from typing import Optional
 
 from facefusion.filesystem import is_file
@@ -12,15 +13,22 @@ def create_hash(content : bytes) -> str:
 def validate_hash(validate_path : str) -> bool:
 	hash_path = get_hash_path(validate_path)
 
-	if is_file(hash_path):
-		with open(hash_path, 'r') as hash_file:
-			hash_content = hash_file.read().strip()
+	if hash_path and is_file(hash_path):
+		validate_stat = os.stat(validate_path)
+		hash_stat = os.stat(hash_path)
+		return validate_hash_by_stat(validate_path, hash_path, validate_stat.st_size, validate_stat.st_mtime_ns, hash_stat.st_mtime_ns)
+	return False
 
-		with open(validate_path, 'rb') as validate_file:
-			validate_content = validate_file.read()
 
-		return create_hash(validate_content) == hash_content
-	return False
+@lru_cache(maxsize = None)
+def validate_hash_by_stat(validate_path : str, hash_path : str, validate_size : int, validate_mtime : int, hash_mtime : int) -> bool:
+	with open(hash_path, 'r') as hash_file:
+		hash_content = hash_file.read().strip()
+
+	with open(validate_path, 'rb') as validate_file:
+		validate_content = validate_file.read()
+
+	return create_hash(validate_content) == hash_content
 
 
 def get_hash_path(validate_path : str) -> Optional[str]:
@@ -390,7 +390,8 @@ def process_frames(source_path : List[str], queue_payloads : List[QueuePayload],
 			'reference_faces': reference_faces,
 			'target_vision_frame': target_vision_frame
 		})
-		write_image(target_vision_path, output_vision_frame)
+		if output_vision_frame is not target_vision_frame:
+			write_image(target_vision_path, output_vision_frame)
 		update_progress(1)
 
 
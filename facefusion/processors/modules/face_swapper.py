@@ -589,7 +589,8 @@ def process_frames(source_paths : List[str], queue_payloads : List[QueuePayload]
 			'source_face': source_face,
 			'target_vision_frame': target_vision_frame
 		})
-		write_image(target_vision_path, output_vision_frame)
+		if output_vision_frame is not target_vision_frame:
+			write_image(target_vision_path, output_vision_frame)
 		update_progress(1)
 
 
@@ -24,7 +24,8 @@ def create_statistics(static_faces : FaceSet) -> Dict[str, Any]:
 	}
 
 	for faces in static_faces.values():
-		statistics['total_frames_with_faces'] = statistics.get('total_frames_with_faces') + 1
+		if faces:
+			statistics['total_frames_with_faces'] = statistics.get('total_frames_with_faces') + 1
 		for face in faces:
 			statistics['total_faces'] = statistics.get('total_faces') + 1
 			face_detector_scores.append(face.score_set.get('detector'))
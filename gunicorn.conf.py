@@ -0,0 +1,21 @@
+# Picked up automatically when running: gunicorn web:app
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = f"{os.getenv('FLASK_RUN_HOST', '0.0.0.0')}:{os.getenv('FLASK_RUN_PORT', 49200)}"
+
+# Every worker process starts its own FACEFUSION_WORKERS facefusion processes, one is usually enough
+workers = int(os.getenv('GUNICORN_WORKERS', 1))
+
+# Threads serve concurrent requests while others wait on Appwrite or facefusion
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+# Queued swaps run to completion when a worker shuts down, a worker killed mid job leaves it processing
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT') or os.getenv('FACEFUSION_TIMEOUT', 3600))
@@ -0,0 +1,35 @@
+import numpy
+
+from facefusion.face_helper import calc_paste_area, paste_back
+
+
+def test_calc_paste_area() -> None:
+	temp_vision_frame = numpy.zeros((100, 100, 3), numpy.uint8)
+	crop_vision_frame = numpy.zeros((10, 10, 3), numpy.uint8)
+	affine_matrix = numpy.array([ [ 1, 0, -20 ], [ 0, 1, -30 ] ], numpy.float64)
+	paste_bounding_box, paste_matrix = calc_paste_area(temp_vision_frame, crop_vision_frame, affine_matrix)
+
+	assert paste_bounding_box.tolist() == [ 19, 29, 31, 41 ]
+	assert paste_matrix.tolist() == [ [ 1, 0, 1 ], [ 0, 1, 1 ] ]
+
+	affine_matrix = numpy.array([ [ 1, 0, 95 ], [ 0, 1, 95 ] ], numpy.float64)
+	paste_bounding_box, _ = calc_paste_area(temp_vision_frame, crop_vision_frame, affine_matrix)
+
+	assert paste_bounding_box.tolist() == [ 0, 0, 0, 0 ]
+
+
+def test_paste_back() -> None:
+	temp_vision_frame = numpy.zeros((100, 100, 3), numpy.uint8)
+	crop_vision_frame = numpy.full((10, 10, 3), 255, numpy.uint8)
+	crop_mask = numpy.ones((10, 10), numpy.float32)
+	affine_matrix = numpy.array([ [ 1, 0, -20 ], [ 0, 1, -30 ] ], numpy.float64)
+	paste_vision_frame = paste_back(temp_vision_frame, crop_vision_frame, crop_mask, affine_matrix)
+
+	assert numpy.all(paste_vision_frame[30:40, 20:30] == 255)
+	assert paste_vision_frame.sum() == 255 * 10 * 10 * 3
+	assert temp_vision_frame.sum() == 0
+
+	affine_matrix = numpy.array([ [ 1, 0, 95 ], [ 0, 1, 95 ] ], numpy.float64)
+	paste_vision_frame = paste_back(temp_vision_frame, crop_vision_frame, crop_mask, affine_matrix)
+
+	assert numpy.array_equal(paste_vision_frame, temp_vision_frame)
@@ -0,0 +1,8 @@
+from facefusion.statistics import create_statistics
+
+
+def test_create_statistics_without_faces() -> None:
+	statistics = create_statistics({ 'frame_1': [], 'frame_2': [] })
+
+	assert statistics.get('total_frames_with_faces') == 0
+	assert statistics.get('total_faces') == 0
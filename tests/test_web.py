@@ -0,0 +1,217 @@
+import importlib
+import io
+import json
+import os
+import tempfile
+from types import ModuleType
+from typing import Any, Dict, List
+from unittest.mock import mock_open
+
+import pytest
+import requests
+from appwrite.exception import AppwriteException
+
+
+class FakeSession:
+	def __init__(self, responses : List[Any]) -> None:
+		self.responses = responses
+		self.calls : List[Dict[str, Any]] = []
+
+	def get(self, url : str, **kwargs : Any) -> requests.Response:
+		return self.request('GET', url, **kwargs)
+
+	def request(self, method : str, url : str, **kwargs : Any) -> requests.Response:
+		# Headers are copied, upload_file keeps changing its dict between chunks
+		self.calls.append(
+		{
+			'method': method,
+			'url': url,
+			'headers': dict(kwargs.get('headers') or {}),
+			'data': kwargs.get('data')
+		})
+		response = self.responses.pop(0)
+
+		if isinstance(response, Exception):
+			raise response
+		return response
+
+
+def create_response(status_code : int, body : Dict[str, Any]) -> requests.Response:
+	response = requests.Response()
+	response.status_code = status_code
+	response.headers['Content-Type'] = 'application/json'
+	response._content = json.dumps(body).encode()
+	return response
+
+
+@pytest.fixture(scope = 'module')
+def web() -> ModuleType:
+	os.environ.update(
+	{
+		'ENDPOINT_SECRET': 'secret',
+		'APPWRITE_ENDPOINT': 'http://appwrite.test/v1',
+		'APPWRITE_PROJECT_ID': 'project',
+		'APPWRITE_API_KEY': 'key',
+		'APPWRITE_DATABASE_ID': 'database',
+		'APPWRITE_JOBS_COLLECTION_ID': 'jobs',
+		'APPWRITE_SOURCE_BUCKET_ID': 'source',
+		'APPWRITE_TARGET_BUCKET_ID': 'target',
+		'APPWRITE_RESULT_BUCKET_ID': 'result',
+		'UPLOADS_DIR': os.path.join(tempfile.gettempdir(), 'facefusion-test-web')
+	})
+	return importlib.import_module('web')
+
+
+def test_is_appwrite_id(web : ModuleType) -> None:
+	assert web.is_appwrite_id('6ad1344f0000a26edc5e') is True
+	assert web.is_appwrite_id('a.b-c_d') is True
+	assert web.is_appwrite_id('a' * 36) is True
+
+	assert web.is_appwrite_id('') is False
+	assert web.is_appwrite_id('a' * 37) is False
+	assert web.is_appwrite_id('_results') is False
+	assert web.is_appwrite_id('../../target') is False
+	assert web.is_appwrite_id('a/b') is False
+	assert web.is_appwrite_id('a\n') is False
+	assert web.is_appwrite_id(None) is False
+
+
+def test_fetch_file_outside_cache(web : ModuleType) -> None:
+	path_prefix = web.TARGET_DIR / 'job_target'
+
+	with pytest.raises(ValueError):
+		web.fetch_file(web.APPWRITE_TARGET_BUCKET_ID, '../../target', path_prefix)
+	with pytest.raises(ValueError):
+		web.fetch_file(web.APPWRITE_TARGET_BUCKET_ID, '..', path_prefix)
+
+
+def test_swap_faces_with_invalid_ids(web : ModuleType, monkeypatch : pytest.MonkeyPatch) -> None:
+	job_statuses : List[str] = []
+	job_document : Dict[str, Any] = { 'faceId': 'face', 'mediaId': '../../target' }
+	monkeypatch.setattr(web, 'get_job_document', lambda job_id: job_document)
+	monkeypatch.setattr(web, 'update_job_status', lambda job_id, status, *args: job_statuses.append(status))
+	client = web.app.test_client()
+
+	response = client.post('/v1/swap-faces', json = { 'secret': 'secret', 'jobId': '../job' })
+
+	assert response.status_code == 400
+	assert job_statuses == []
+
+	response = client.post('/v1/swap-faces', json = { 'secret': 'secret', 'jobId': 'job' })
+
+	assert response.status_code == 400
+	assert job_statuses == [ 'failed' ]
+	assert web.active_jobs == set()
+
+
+def test_upload_file(web : ModuleType, monkeypatch : pytest.MonkeyPatch) -> None:
+	file_path = os.path.join(tempfile.gettempdir(), 'facefusion-test-web-upload.jpg')
+	fake_session = FakeSession([ create_response(201, { '$id': 'file' }) for _ in range(3) ])
+	monkeypatch.setattr(web, 'http_session', fake_session)
+	monkeypatch.setattr(web, 'UPLOAD_CHUNK_SIZE', 4)
+
+	with open(file_path, 'wb') as file:
+		file.write(b'0123456789')
+
+	assert web.upload_file('result', file_path) == 'file'
+	assert [ call.get('headers').get('Content-Range') for call in fake_session.calls ] == [ 'bytes 0-3/10', 'bytes 4-7/10', 'bytes 8-9/10' ]
+	assert [ call.get('headers').get('X-Appwrite-Id') for call in fake_session.calls ] == [ None, 'file', 'file' ]
+	assert len({ call.get('data').get('fileId') for call in fake_session.calls }) == 1
+
+	fake_session = FakeSession([ create_response(201, { '$id': 'file' }) ])
+	monkeypatch.setattr(web, 'http_session', fake_session)
+	monkeypatch.setattr(web, 'UPLOAD_CHUNK_SIZE', 16)
+
+	assert web.upload_file('result', file_path) == 'file'
+	assert fake_session.calls[0].get('headers') == {}
+
+
+def test_upload_chunk(web : ModuleType, monkeypatch : pytest.MonkeyPatch) -> None:
+	monkeypatch.setattr(web, 'UPLOAD_RETRY_DELAY', 0)
+	file_part = ('result.jpg', b'0123', 'image/jpeg')
+
+	fake_session = FakeSession([ requests.ConnectionError(), create_response(429, {}), create_response(503, {}), create_response(201, { '$id': 'file' }) ])
+	monkeypatch.setattr(web, 'http_session', fake_session)
+
+	assert web.upload_chunk('url', {}, 'file', file_part) == { '$id': 'file' }
+	assert len(fake_session.calls) == 4
+
+	fake_session = FakeSession([ create_response(500, {}), create_response(409, {}) ])
+	monkeypatch.setattr(web, 'http_session', fake_session)
+
+	assert web.upload_chunk('url', {}, 'file', file_part) == { '$id': 'file' }
+
+	for status_code in [ 400, 409 ]:
+		fake_session = FakeSession([ create_response(status_code, {}) ])
+		monkeypatch.setattr(web, 'http_session', fake_session)
+
+		with pytest.raises(AppwriteException):
+			web.upload_chunk('url', {}, 'file', file_part)
+		assert len(fake_session.calls) == 1
+
+	fake_session = FakeSession([ create_response(500, {}) for _ in range(web.UPLOAD_CHUNK_RETRIES + 1) ])
+	monkeypatch.setattr(web, 'http_session', fake_session)
+
+	with pytest.raises(AppwriteException):
+		web.upload_chunk('url', {}, 'file', file_part)
+	assert fake_session.responses == []
+
+
+def test_download_file_over_limit(web : ModuleType, monkeypatch : pytest.MonkeyPatch) -> None:
+	monkeypatch.setattr(web, 'MAX_MEDIA_BYTES', 300)
+	path_prefix = web.TARGET_DIR / 'job_target'
+
+	for headers in [ { 'Content-Length': '400' }, { 'Content-Encoding': 'gzip' } ]:
+		response = requests.Response()
+		response.status_code = 200
+		response.headers.update(headers)
+		response.raw = io.BytesIO(bytes(400))
+		monkeypatch.setattr(web, 'http_session', FakeSession([ response ]))
+
+		with pytest.raises(web.MediaTooLargeError):
+			web.download_file('target', 'file', path_prefix)
+		assert list(web.TARGET_DIR.glob('job_target*')) == []
+
+
+def test_get_download_extension(web : ModuleType) -> None:
+	response = requests.Response()
+	png_head = b'\x89PNG\r\n\x1a\n' + bytes(16)
+
+	response.headers['Content-Disposition'] = 'attachment; filename="Clip.MP4"'
+	assert web.get_download_extension(response, png_head) == '.mp4'
+
+	response.headers['Content-Disposition'] = 'attachment; filename="clip"'
+	assert web.get_download_extension(response, png_head) == '.png'
+
+	del response.headers['Content-Disposition']
+	assert web.get_download_extension(response, png_head) == '.png'
+	assert web.get_download_extension(response, bytes(16)) == ''
+
+
+def test_is_tmpfs(web : ModuleType, monkeypatch : pytest.MonkeyPatch) -> None:
+	mounts = '\n'.join(
+	[
+		'/dev/root / ext4 rw 0 0',
+		'tmpfs /srv tmpfs rw 0 0',
+		'/dev/sdb /srv/disk ext4 rw 0 0',
+		'/dev/sdc /srv/my\\040disk ext4 rw 0 0'
+	])
+	monkeypatch.setattr(web, 'open', mock_open(read_data = mounts), raising = False)
+
+	assert web.is_tmpfs('/srv/jobs') is True
+	assert web.is_tmpfs('/srv/diskless') is True
+	assert web.is_tmpfs('/srv/disk/jobs') is False
+	assert web.is_tmpfs('/srv/my disk/jobs') is False
+	assert web.is_tmpfs('/var/jobs') is False
+
+
+def test_require_secret(web : ModuleType) -> None:
+	client = web.app.test_client()
+
+	assert client.post('/v1/swap-faces', data = b'{', content_type = 'application/json').status_code == 400
+	assert client.post('/v1/swap-faces', json = [ 'secret' ]).status_code == 400
+	assert client.post('/v1/swap-faces', json = { 'secret': 1 }).status_code == 400
+	assert client.post('/v1/swap-faces', json = { 'jobId': 'job' }).status_code == 401
+	assert client.post('/v1/swap-faces', json = { 'secret': 'invalid', 'jobId': 'job' }).status_code == 401
+	assert client.post('/v1/swap-faces', json = { 'secret': 'secret' }).status_code == 400
+	assert client.post('/v1/swap-faces', json = { 'secret': 'secret', 'jobId': 'a' * 20000 }).status_code == 413
@@ -1,88 +1,518 @@
+import atexit
+import collections
+import email.message
+import errno
+import functools
+import hashlib
+import logging
+import mimetypes
+import multiprocessing
 import os
-import sys
-import subprocess
-import uuid
+import queue
+import re
 import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from hmac import compare_digest
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-import traceback # For detailed error logging
 
-from flask import Flask, request, jsonify
-from dotenv import load_dotenv
-from appwrite.client import Client
-from appwrite.services.databases import Databases
-from appwrite.services.storage import Storage
-from appwrite.input_file import InputFile
-from appwrite.id import ID
+import filetype
+import orjson
+import requests
 from appwrite.exception import AppwriteException
+from appwrite.id import ID
+from dotenv import load_dotenv
+from flask import Flask, current_app, jsonify, request
+from flask.json.provider import JSONProvider
+from pydantic import BaseModel, ValidationError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from worker import run_worker
+
+from facefusion import metadata as facefusion_metadata
 
 load_dotenv()
 
+# Records are handed to a listener thread, so job and request threads never block on stderr
+logger = logging.getLogger('web')
+logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+logger.propagate = False
+log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(log_queue))
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(threadName)s] %(message)s'))
+log_listener = QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
 FLASK_HOST = os.getenv('FLASK_RUN_HOST', '0.0.0.0')
 FLASK_PORT = int(os.getenv('FLASK_RUN_PORT', 49200))
+FACEFUSION_TIMEOUT = int(os.getenv('FACEFUSION_TIMEOUT', 3600))
+FACEFUSION_WORKERS = int(os.getenv('FACEFUSION_WORKERS', 1))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+PROCESSING_STATUS_DELAY = float(os.getenv('PROCESSING_STATUS_DELAY', 2.0))
+FILE_CACHE_SIZE_MB = int(os.getenv('FILE_CACHE_SIZE_MB', 512))
+JOB_FILES_SIZE_MB = int(os.getenv('JOB_FILES_SIZE_MB', 512))
+MAX_MEDIA_SIZE_MB = int(os.getenv('MAX_MEDIA_SIZE_MB', 2048))
 ENDPOINT_SECRET = os.getenv('ENDPOINT_SECRET')
 APPWRITE_ENDPOINT = os.getenv('APPWRITE_ENDPOINT')
 APPWRITE_PROJECT_ID = os.getenv('APPWRITE_PROJECT_ID')
 APPWRITE_API_KEY = os.getenv('APPWRITE_API_KEY')
 APPWRITE_DATABASE_ID = os.getenv('APPWRITE_DATABASE_ID')
 APPWRITE_JOBS_COLLECTION_ID = os.getenv('APPWRITE_JOBS_COLLECTION_ID')
+# Optional integer attribute of the job document that receives progress percentages
+APPWRITE_PROGRESS_ATTRIBUTE = os.getenv('APPWRITE_PROGRESS_ATTRIBUTE')
 
 APPWRITE_SOURCE_BUCKET_ID = os.getenv('APPWRITE_SOURCE_BUCKET_ID')
 APPWRITE_TARGET_BUCKET_ID = os.getenv('APPWRITE_TARGET_BUCKET_ID')
 APPWRITE_RESULT_BUCKET_ID = os.getenv('APPWRITE_RESULT_BUCKET_ID')
 
 if not ENDPOINT_SECRET:
-    print("Error: ENDPOINT_SECRET not set in .env file.", file=sys.stderr)
+    logger.error("ENDPOINT_SECRET not set in .env file.")
     sys.exit(1)
 
+ENDPOINT_SECRET_BYTES = ENDPOINT_SECRET.encode('utf-8')
+
 if not all([APPWRITE_ENDPOINT, APPWRITE_PROJECT_ID, APPWRITE_API_KEY, APPWRITE_DATABASE_ID, APPWRITE_JOBS_COLLECTION_ID]):
-    print("Error: Missing required core Appwrite configuration in .env file.", file=sys.stderr)
+    logger.error("Missing required core Appwrite configuration in .env file.")
     sys.exit(1)
 
 if not all([APPWRITE_SOURCE_BUCKET_ID, APPWRITE_TARGET_BUCKET_ID, APPWRITE_RESULT_BUCKET_ID]):
-    print("Error: Missing required Appwrite Storage bucket IDs (SOURCE, TARGET, RESULT) in .env file.", file=sys.stderr)
+    logger.error("Missing required Appwrite Storage bucket IDs (SOURCE, TARGET, RESULT) in .env file.")
     sys.exit(1)
 
+def is_tmpfs(path):
+    """Check whether path lives on a RAM backed filesystem, using the closest mount point in /proc/mounts"""
+    path = str(Path(path).resolve())
+    mount_fs_type, mount_length = None, -1
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                _, mount_point, fs_type = line.split()[:3]
+                mount_point = mount_point.replace('\\040', ' ')
+                is_parent = path == mount_point or path.startswith(mount_point.rstrip('/') + '/')
+                if is_parent and len(mount_point) > mount_length:
+                    mount_fs_type, mount_length = fs_type, len(mount_point)
+    except OSError:
+        return False
+    return mount_fs_type in ('tmpfs', 'ramfs')
+
 BASE_DIR = Path(__file__).resolve().parent
-UPLOADS_DIR = BASE_DIR / "uploads"
+# Job files only live for a single swap, keep them on tmpfs when available
+SHM_DIR = Path('/dev/shm')
+DEFAULT_UPLOADS_DIR = SHM_DIR / "facefusion_jobs" if SHM_DIR.is_dir() else BASE_DIR / "uploads"
+UPLOADS_DIR = Path(os.getenv('UPLOADS_DIR') or DEFAULT_UPLOADS_DIR)
 SOURCE_DIR = UPLOADS_DIR / "source"
 TARGET_DIR = UPLOADS_DIR / "target"
 OUTPUT_DIR = UPLOADS_DIR / "output"
+# Downloaded inputs kept across jobs, hardlinked into the job directories
+CACHE_DIR = UPLOADS_DIR / "cache"
+# Swap results keyed by content, Appwrite IDs cannot start with an underscore so no bucket collides
+RESULT_CACHE_DIR = CACHE_DIR / "_results"
 
 SOURCE_DIR.mkdir(parents=True, exist_ok=True)
 TARGET_DIR.mkdir(parents=True, exist_ok=True)
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-
-FACEFUSION_SCRIPT_PATH = BASE_DIR / "facefusion.py"
+CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+# Downloads too large for the tmpfs spill over to disk, along with their results
+SPILL_DIR = None
+if is_tmpfs(UPLOADS_DIR):
+    SPILL_DIR = BASE_DIR / "uploads"
+    for spill_subdir in ("source", "target", "output"):
+        (SPILL_DIR / spill_subdir).mkdir(parents=True, exist_ok=True)
+else:
+    logger.warning("UPLOADS_DIR %s is not on tmpfs, job files will go through the disk.", UPLOADS_DIR)
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# Largest chunk Appwrite accepts per upload request
+UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
+UPLOAD_CHUNK_RETRIES = 3
+UPLOAD_RETRY_DELAY = 0.5
+FFMPEG_STDERR_TAIL = 20
+# Enough leading bytes for filetype to recognise every format it knows
+FILE_SNIFF_SIZE = 262
+VIDEO_EXTENSIONS = frozenset({'.mp4', '.mov', '.m4v', '.mkv', '.webm', '.avi'})
+PREVIEW_DURATION = 3
+# Preferred first, NVENC takes the encode off the CPU when a GPU is present
+PREVIEW_ENCODERS = [
+    ('h264_nvenc', ['-preset', 'p1']),
+    ('libx264', ['-preset', 'ultrafast', '-crf', '28'])
+]
+FILE_CACHE_MAX_BYTES = FILE_CACHE_SIZE_MB * 1024 * 1024
+JOB_FILES_MAX_BYTES = JOB_FILES_SIZE_MB * 1024 * 1024
+MAX_MEDIA_BYTES = MAX_MEDIA_SIZE_MB * 1024 * 1024
+
+# The tmpfs has to hold the input cache plus the files of every concurrent job
+uploads_total = shutil.disk_usage(UPLOADS_DIR).total
+uploads_required = FILE_CACHE_MAX_BYTES + JOB_WORKERS * JOB_FILES_MAX_BYTES
+if SPILL_DIR and uploads_total < uploads_required:
+    logger.warning("tmpfs at %s holds %d MB but the input cache and %d jobs need %d MB, larger jobs will spill to disk.", UPLOADS_DIR, uploads_total >> 20, JOB_WORKERS, uploads_required >> 20)
+# The workers read their options from facefusion.ini, a changed config or release must not hit old results
+FACEFUSION_CONFIG_PATH = Path('facefusion.ini')
+FACEFUSION_SETTINGS_DIGEST = hashlib.sha256(
+    facefusion_metadata.get('version').encode() + (FACEFUSION_CONFIG_PATH.read_bytes() if FACEFUSION_CONFIG_PATH.is_file() else b'')
+).hexdigest()
+# Request URLs are assembled from these prefixes instead of formatting the full path on every call
+# Appwrite's custom ID format, IDs end up in cache and job file paths so nothing else gets through
+APPWRITE_ID_PATTERN = re.compile(r'[a-zA-Z0-9][a-zA-Z0-9._-]{0,35}')
+APPWRITE_BASE_URL = APPWRITE_ENDPOINT.rstrip('/')
+JOB_DOCUMENTS_URL = f"{APPWRITE_BASE_URL}/databases/{APPWRITE_DATABASE_ID}/collections/{APPWRITE_JOBS_COLLECTION_ID}/documents/"
+STORAGE_BUCKETS_URL = f"{APPWRITE_BASE_URL}/storage/buckets/"
+APPWRITE_HEADERS = {
+    'X-Appwrite-Project': APPWRITE_PROJECT_ID,
+    'X-Appwrite-Key': APPWRITE_API_KEY,
+}
+
+class ORJSONProvider(JSONProvider):
+    """Serve jsonify and get_json through orjson, responses are built from its bytes without a decode"""
+    def dumps(self, obj, **kwargs):
+        """Serialize obj, json.dumps options such as indent or sort_keys have no orjson counterpart and are ignored"""
+        return orjson.dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        """Parse s, json.loads options are ignored the same way"""
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        """Build a JSON response from jsonify style arguments, a single value, several values or keyword arguments"""
+        if args and kwargs:
+            raise TypeError("jsonify() takes either positional or keyword arguments, not both")
+        if len(args) == 1:
+            obj = args[0]
+        else:
+            obj = list(args) or kwargs or None
+        return current_app.response_class(orjson.dumps(obj), mimetype='application/json')
 
 app = Flask(__name__)
-
-client = Client()
-client.set_endpoint(APPWRITE_ENDPOINT)
-client.set_project(APPWRITE_PROJECT_ID)
-client.set_key(APPWRITE_API_KEY)
-
-databases = Databases(client)
-storage = Storage(client)
-
-def update_job_status(job_id, status, result_id=None):
+app.json = ORJSONProvider(app)
+# Job requests are a few short fields, anything larger is rejected before parsing
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024
+
+# One pooled keep-alive session for all Appwrite REST calls
+http_session = requests.Session()
+http_session.headers.update(APPWRITE_HEADERS)
+# Each job holds up to three connections at once, two downloads or the result and preview uploads plus a status write
+# 429 waits out Retry-After, an exhausted retry hands back the last response so it is reported as an AppwriteException
+http_retry = Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {'PATCH'}, raise_on_status=False)
+http_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max(32, JOB_WORKERS * 3), max_retries=http_retry)
+http_session.mount('https://', http_adapter)
+http_session.mount('http://', http_adapter)
+
+# Swap jobs run in the background so requests return as soon as a job is queued
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+cleanup_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='cleanup')
+
+# Serialises cache eviction scans
+file_cache_lock = threading.Lock()
+
+# Job IDs queued or running in this process
+active_jobs = set()
+active_jobs_lock = threading.Lock()
+
+# Swaps in progress keyed by (faceId, mediaId), resolving to their result and preview IDs
+swap_flights = {}
+swap_flights_lock = threading.Lock()
+
+# Pending 'processing' status writes, keyed by job ID
+processing_timers = {}
+processing_timers_lock = threading.Lock()
+
+# Persistent facefusion workers, each keeps its imports and models loaded across jobs
+worker_context = multiprocessing.get_context('spawn')
+idle_workers = queue.Queue()
+for worker_index in range(FACEFUSION_WORKERS):
+    idle_workers.put({'index': worker_index, 'process': None, 'job_queue': None, 'result_queue': None})
+
+class MediaTooLargeError(Exception):
+    """A job's source or target is larger than MAX_MEDIA_SIZE_MB"""
+
+def raise_for_appwrite_status(response):
+    """Raise an AppwriteException for a failed Appwrite REST response, mirroring the SDK"""
+    if response.ok:
+        return
+    if response.headers.get('Content-Type', '').startswith('application/json'):
+        body = response.json()
+        raise AppwriteException(body.get('message'), response.status_code, body.get('type'), response.text)
+    raise AppwriteException(response.text, response.status_code, None, response.text)
+
+def appwrite_call(method, url, **kwargs):
+    """Call the Appwrite REST API over the shared session and return the JSON body"""
+    try:
+        response = http_session.request(method, url, **kwargs)
+    except requests.RequestException as e:
+        raise AppwriteException(str(e)) from e
+    raise_for_appwrite_status(response)
+    return response.json()
+
+def get_job_document(job_id):
+    return appwrite_call('GET', JOB_DOCUMENTS_URL + job_id)
+
+def update_job_document(job_id, data):
+    return appwrite_call('PATCH', JOB_DOCUMENTS_URL + job_id, json={'data': data})
+
+def claim_job(job_id):
+    """Mark the job as in flight, returns False when it already is"""
+    with active_jobs_lock:
+        if job_id in active_jobs:
+            return False
+        active_jobs.add(job_id)
+        return True
+
+def release_job(job_id):
+    with active_jobs_lock:
+        active_jobs.discard(job_id)
+
+def schedule_processing_status(job_id):
+    """Mark the job as processing only once it runs longer than PROCESSING_STATUS_DELAY"""
+    timer = threading.Timer(PROCESSING_STATUS_DELAY, update_job_status, args=(job_id, 'processing'))
+    timer.daemon = True
+    with processing_timers_lock:
+        processing_timers[job_id] = timer
+    timer.start()
+
+def cancel_processing_status(job_id):
+    """Drop a pending processing write, waiting for one in flight so it cannot land after the final status"""
+    with processing_timers_lock:
+        timer = processing_timers.pop(job_id, None)
+    if timer and timer is not threading.current_thread():
+        timer.cancel()
+        timer.join()
+
+def update_job_status(job_id, status, result_id=None, preview_id=None):
+    """Write the job status together with any result fields in a single document update"""
+    if status != 'processing':
+        cancel_processing_status(job_id)
     try:
         data = {'status': status}
         if result_id:
             data['resultId'] = result_id
+        if preview_id:
+            data['mediaPreviewId'] = preview_id
 
-        databases.update_document(
-            database_id=APPWRITE_DATABASE_ID,
-            collection_id=APPWRITE_JOBS_COLLECTION_ID,
-            document_id=job_id,
-            data=data
-        )
-        print(f"Job {job_id} status updated to {status}")
+        update_job_document(job_id, data)
+        logger.info("Job %s status updated to %s", job_id, status)
     except AppwriteException as e:
-        print(f"Error updating job {job_id} status to {status}: {e}", file=sys.stderr)
+        logger.error("Error updating job %s status to %s: %s", job_id, status, e)
         if hasattr(e, 'response') and e.response:
-             print(f"Appwrite Response (Update Error): {e.response}", file=sys.stderr)
+             logger.error("Appwrite Response (Update Error): %s", e.response)
     except Exception as e:
-        print(f"Unexpected error updating job {job_id}: {e}", file=sys.stderr)
+        logger.error("Unexpected error updating job %s: %s", job_id, e)
+
+def get_download_extension(response, file_head):
+    """Take the extension from the download's Content-Disposition name, sniffing the first bytes as a fallback"""
+    disposition = email.message.Message()
+    disposition['Content-Disposition'] = response.headers.get('Content-Disposition', '')
+    file_extension = get_file_extension(disposition.get_filename())
+    if not file_extension:
+        sniffed_extension = filetype.guess_extension(file_head)
+        file_extension = f".{sniffed_extension}" if sniffed_extension else ""
+    return file_extension
+
+def download_file(bucket_id, file_id, path_prefix):
+    """Stream a file from Appwrite Storage to path_prefix plus its extension, returning the path and SHA-256"""
+    url = f"{STORAGE_BUCKETS_URL}{bucket_id}/files/{file_id}/download"
+    with http_session.get(url, stream=True) as response:
+        raise_for_appwrite_status(response)
+        # Copy straight from the socket reader, sendfile/splice do not apply to TLS sockets.
+        # Decoding is opt-in, urllib3 passes every decoded chunk through an extra buffer.
+        is_encoded = 'Content-Encoding' in response.headers
+        response.raw.decode_content = is_encoded
+        file_head = response.raw.read(FILE_SNIFF_SIZE)
+        # Content-Length is the transfer size, it only matches the file when nothing is encoded
+        file_size = 0 if is_encoded else int(response.headers.get('Content-Length', 0))
+        # Refuse oversized media before any of it is written, encoded responses are checked while streaming
+        if MAX_MEDIA_BYTES and file_size > MAX_MEDIA_BYTES:
+            raise MediaTooLargeError(f"File {file_id} is {file_size} bytes, over the {MAX_MEDIA_BYTES} byte limit")
+        # Leave room for a result of similar size, anything bigger goes to the disk backed directory
+        if SPILL_DIR and file_size > shutil.disk_usage(path_prefix.parent).free // 2:
+            path_prefix = SPILL_DIR / path_prefix.parent.name / path_prefix.name
+        file_path = path_prefix.with_name(f"{path_prefix.name}{get_download_extension(response, file_head)}")
+        try:
+            with open(file_path, 'wb') as f:
+                if file_size and hasattr(os, 'posix_fallocate'):
+                    # Reserve the space up front, a full disk or tmpfs fails here instead of mid-download
+                    os.posix_fallocate(f.fileno(), 0, file_size)
+                # Hash while streaming so the result cache key costs no second read
+                file_hash = hashlib.sha256(file_head)
+                f.write(file_head)
+                for chunk in iter(functools.partial(response.raw.read, DOWNLOAD_CHUNK_SIZE), b''):
+                    file_hash.update(chunk)
+                    f.write(chunk)
+                    if MAX_MEDIA_BYTES and f.tell() > MAX_MEDIA_BYTES:
+                        raise MediaTooLargeError(f"File {file_id} is over the {MAX_MEDIA_BYTES} byte limit")
+                f.truncate()
+        except BaseException:
+            # The caller never learns the path of a failed download, drop the partial file here
+            file_path.unlink(missing_ok=True)
+            raise
+    return file_path, file_hash.hexdigest()
+
+def upload_chunk(url, headers, file_id, file_part):
+    """POST one upload chunk, retrying transient failures with backoff so an upload resumes at the failed chunk"""
+    for attempt in range(UPLOAD_CHUNK_RETRIES + 1):
+        try:
+            return appwrite_call('POST', url, headers=headers, data={'fileId': file_id}, files={'file': file_part})
+        except AppwriteException as e:
+            # The previous attempt reached Appwrite after all and only its response was lost
+            if attempt and e.code == 409:
+                return {'$id': file_id}
+            # Connection errors carry no code, 429 and 5xx are worth another try
+            if attempt == UPLOAD_CHUNK_RETRIES or (e.code and e.code != 429 and e.code < 500):
+                raise
+            logger.warning("Retrying upload chunk of %s after error: %s", file_id, e)
+        time.sleep(UPLOAD_RETRY_DELAY * 2 ** attempt)
+
+def upload_file(bucket_id, file_path):
+    """Upload a file to Appwrite Storage in chunks over the shared session and return its ID"""
+    file_id = ID.unique()
+    file_size = os.path.getsize(file_path)
+    file_name = os.path.basename(file_path)
+    mime_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+    headers = {}
+
+    with open(file_path, 'rb') as f:
+        for offset in range(0, max(file_size, 1), UPLOAD_CHUNK_SIZE):
+            chunk = f.read(UPLOAD_CHUNK_SIZE)
+            if file_size > UPLOAD_CHUNK_SIZE:
+                headers['Content-Range'] = f"bytes {offset}-{offset + len(chunk) - 1}/{file_size}"
+            upload_response = upload_chunk(f"{STORAGE_BUCKETS_URL}{bucket_id}/files", headers, file_id, (file_name, chunk, mime_type))
+            # Follow-up chunks are appended to the file created by the first one
+            headers['X-Appwrite-Id'] = upload_response['$id']
+    return upload_response['$id']
+
+def get_result_key(face_digest, media_digest):
+    """Content address of a swap, covering both inputs and the facefusion settings"""
+    return hashlib.sha256(f"{face_digest}:{media_digest}:{FACEFUSION_SETTINGS_DIGEST}".encode()).hexdigest()
+
+def is_appwrite_id(value):
+    """Check that value is a valid Appwrite ID and therefore safe to use as a path component"""
+    return isinstance(value, str) and APPWRITE_ID_PATTERN.fullmatch(value) is not None
+
+def fetch_file(bucket_id, file_id, path_prefix):
+    """Provide a stored file at path_prefix plus its extension, from the cache or a fresh download, with its SHA-256"""
+    cache_dir = CACHE_DIR / bucket_id / file_id
+    # The cache is read before Appwrite sees the ID, it must not reach into another directory
+    if CACHE_DIR.resolve() not in cache_dir.resolve().parents:
+        raise ValueError(f"File ID {file_id} points outside the cache")
+    file_path, cache_path = link_cached_file(cache_dir, path_prefix)
+    if file_path:
+        logger.info("Using cached copy of %s", file_id)
+        # Cached inputs are named after their content hash
+        return file_path, cache_path.stem
+    file_path, file_digest = download_file(bucket_id, file_id, path_prefix)
+    cache_file(file_path, cache_dir / f"{file_digest}{file_path.suffix}")
+    return file_path, file_digest
+
+def link_cached_file(cache_dir, path_prefix):
+    """Hardlink the cached copy to path_prefix, deleting the job file later leaves the cache intact"""
+    if FILE_CACHE_MAX_BYTES <= 0:
+        return None, None
+    try:
+        # Files only enter the cache once complete, so any entry can be used
+        cache_path = next(cache_dir.iterdir(), None)
+        if not cache_path:
+            return None, None
+        file_path = path_prefix.with_name(f"{path_prefix.name}{cache_path.suffix}")
+        os.link(cache_path, file_path)
+        # The modification time doubles as the last use for eviction
+        os.utime(cache_path)
+        return file_path, cache_path
+    except OSError:
+        return None, None
+
+def cache_file(file_path, cache_path):
+    """Add a finished download to the cache and trim the cache in the background"""
+    if FILE_CACHE_MAX_BYTES <= 0:
+        return
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        os.link(file_path, cache_path)
+    except FileExistsError:
+        # Another job cached the same file first
+        return
+    except OSError as e:
+        # Spilled downloads sit on another filesystem and are not cached
+        if e.errno != errno.EXDEV:
+            logger.warning("Could not cache %s: %s", file_path, e)
+        return
+    cleanup_executor.submit(evict_file_cache)
+
+def evict_file_cache():
+    """Delete the least recently used cache files until the cache fits FILE_CACHE_MAX_BYTES"""
+    with file_cache_lock:
+        cache_entries = []
+        for cache_path in CACHE_DIR.glob('*/*/*'):
+            try:
+                stat = cache_path.stat()
+            except FileNotFoundError:
+                continue
+            cache_entries.append((stat.st_mtime, stat.st_size, cache_path))
+        cache_bytes = sum(entry[1] for entry in cache_entries)
+
+        for _, file_size, cache_path in sorted(cache_entries):
+            if cache_bytes <= FILE_CACHE_MAX_BYTES:
+                break
+            cache_path.unlink(missing_ok=True)
+            cache_bytes -= file_size
+            try:
+                cache_path.parent.rmdir()
+            except OSError:
+                pass
+
+def start_facefusion_worker(worker):
+    """Start the worker's facefusion process unless it is already running"""
+    if worker['process'] and worker['process'].is_alive():
+        return
+    logger.info("Starting facefusion worker process %s...", worker['index'])
+    worker['job_queue'] = worker_context.Queue()
+    worker['result_queue'] = worker_context.Queue()
+    worker['process'] = worker_context.Process(target=run_worker, args=(worker['job_queue'], worker['result_queue']), daemon=True)
+    worker['process'].start()
+
+def report_job_progress(message):
+    """Log a facefusion progress message and mirror it to the job document when configured"""
+    logger.info("Job %s %s: %s%%", message['job_id'], message['stage'], message['progress'])
+    if not APPWRITE_PROGRESS_ATTRIBUTE:
+        return
+    try:
+        update_job_document(message['job_id'], {APPWRITE_PROGRESS_ATTRIBUTE: message['progress']})
+    except AppwriteException as e:
+        logger.error("Error updating job %s progress: %s", message['job_id'], e)
+
+def run_facefusion(job_id, source_path, target_path, output_path):
+    """Hand a swap job to the next idle facefusion worker and wait for its result"""
+    worker = idle_workers.get()
+    try:
+        start_facefusion_worker(worker)
+        worker['job_queue'].put({
+            'job_id': job_id,
+            'source_path': str(source_path),
+            'target_path': str(target_path),
+            'output_path': str(output_path)
+        })
+        deadline = time.monotonic() + FACEFUSION_TIMEOUT
+
+        while True:
+            try:
+                message = worker['result_queue'].get(timeout=1)
+                # Progress messages stream in ahead of the final result
+                if 'progress' not in message:
+                    return message
+                report_job_progress(message)
+            except queue.Empty:
+                if not worker['process'].is_alive():
+                    return {'job_id': job_id, 'error_code': 1, 'error': f"Facefusion worker exited unexpectedly (Exit code: {worker['process'].exitcode})"}
+            if time.monotonic() > deadline:
+                worker['process'].kill()
+                worker['process'].join()
+                return {'job_id': job_id, 'error_code': 1, 'error': f"Facefusion worker timed out after {FACEFUSION_TIMEOUT} seconds"}
+    finally:
+        idle_workers.put(worker)
 
 def get_file_extension(filename):
     if not filename or '.' not in filename:
@@ -91,240 +521,232 @@ def get_file_extension(filename):
 
 def is_video_file(file_path):
     """Check if the file is a video file based on extension"""
-    video_extensions = ['.mp4', '.mov']
-    return get_file_extension(str(file_path)) in video_extensions
-
-def create_gif_preview(video_path, output_path, fps=10, width=320):
-    """Create a GIF preview from a video file using ffmpeg"""
+    return Path(file_path).suffix.lower() in VIDEO_EXTENSIONS
+
+@functools.lru_cache(maxsize=None)
+def get_preview_encoder():
+    """Pick the fastest H.264 encoder that works on this host, probed once per process"""
+    for encoder, encoder_options in PREVIEW_ENCODERS:
+        # Listing an encoder is not enough, NVENC builds still fail without a GPU
+        command = ['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'color=size=64x64', '-frames:v', '1', '-c:v', encoder, '-f', 'null', '-']
+        try:
+            if subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30).returncode == 0:
+                return encoder, encoder_options
+        except OSError:
+            # No ffmpeg at all, no other encoder will do better
+            return None
+        except subprocess.SubprocessError as e:
+            # A stalled probe, e.g. on a busy GPU, only rules out this encoder
+            logger.warning("Preview encoder %s probe failed: %s", encoder, e)
+    return None
+
+def create_preview(video_path, output_path, width=320):
+    """Create a short H.264 preview clip from a video file using ffmpeg"""
+    encoder, encoder_options = get_preview_encoder()
     command = [
         'ffmpeg',
+        '-v', 'error',
         '-i', str(video_path),
-        '-vf', f'fps={fps},scale={width}:-1:flags=lanczos',
+        '-t', str(PREVIEW_DURATION),
+        '-an',
+        '-vf', f'scale={width}:-2:flags=fast_bilinear',
+        '-c:v', encoder,
+        *encoder_options,
+        '-pix_fmt', 'yuv420p',
+        '-movflags', '+faststart',
         '-y',
         str(output_path)
     ]
-    
-    process = subprocess.run(
+
+    # Drain stderr as raw bytes and only keep the tail, it is decoded just when reporting a failure
+    process = subprocess.Popen(
         command,
-        capture_output=True,
-        text=True,
-        check=False,
-        encoding='utf-8'
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE
     )
-    return process.returncode == 0
-
-@app.route('/v1/swap-faces', methods=['POST'])
-def swap_faces_endpoint():
-    if not FACEFUSION_SCRIPT_PATH.is_file():
-        print(f"Error: Facefusion script not found at {FACEFUSION_SCRIPT_PATH}", file=sys.stderr)
-        return jsonify({"error": "Server configuration error: Processing script missing."}), 500
-
+    stderr_tail = collections.deque(process.stderr, maxlen=FFMPEG_STDERR_TAIL)
+    process.stderr.close()
+
+    if process.wait() != 0:
+        stderr_output = b''.join(stderr_tail).decode('utf-8', errors='replace')
+        logger.error("ffmpeg preview failed (Return code: %s):\n%s", process.returncode, stderr_output)
+        return False
+    return True
+
+def upload_preview(video_path, preview_path):
+    """Create a preview clip of the video and upload it, returning the preview ID"""
+    if not create_preview(video_path, preview_path):
+        logger.warning("Failed to create preview")
+        return None
     try:
-        data = request.get_json()
-        if not data:
-            return jsonify({"error": "Invalid JSON payload"}), 400
+        preview_id = upload_file(APPWRITE_RESULT_BUCKET_ID, preview_path)
+        logger.info("Preview upload successful. Preview ID: %s", preview_id)
+        return preview_id
     except Exception as e:
-        return jsonify({"error": f"Failed to parse JSON payload: {e}"}), 400
-
-    req_secret = data.get('secret')
-    if not req_secret or req_secret != ENDPOINT_SECRET:
-        print("Unauthorized access attempt: Invalid secret", file=sys.stderr)
-        return jsonify({"error": "Unauthorized"}), 401
-
-    job_id = data.get('jobId')
-    if not job_id:
-        return jsonify({"error": "Missing 'jobId' parameter"}), 400
-
-    print(f"\n--- Received job request: {job_id} ---")
+        logger.warning("Failed to upload preview: %s", e)
+        return None
 
+def delete_files(file_paths):
+    """Delete local job files, runs on the cleanup pool so jobs do not wait on unlink"""
+    for file_path in filter(None, file_paths):
+        # Unlink straight away instead of probing with exists() first, a missing file is fine
+        try:
+            file_path.unlink()
+            logger.debug("Deleted %s", file_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Error deleting file %s: %s", file_path, e)
+
+def process_swap_job(job_id, face_id, media_id):
+    """Run the swap for a job, or attach the job to a running swap of the same face and media and wait for its outcome"""
+    swap_key = (face_id, media_id)
+    with swap_flights_lock:
+        swap_flight = swap_flights.get(swap_key)
+        is_leader = swap_flight is None
+        if is_leader:
+            swap_flight = swap_flights[swap_key] = Future()
+
+    if not is_leader:
+        logger.info("Job %s shares its face and media with a running swap, waiting for its outcome", job_id)
+        schedule_processing_status(job_id)
+        swap_flight.add_done_callback(functools.partial(finish_shared_swap_job, job_id, face_id, media_id))
+        return
+
+    swap_status = None
+    try:
+        swap_status = run_swap_job(job_id, face_id, media_id)
+    finally:
+        with swap_flights_lock:
+            del swap_flights[swap_key]
+        swap_flight.set_result(swap_status)
+
+def finish_shared_swap_job(job_id, face_id, media_id, swap_flight):
+    """Run an attached job once its swap is done, each job document gets its own result file and never shares its resultId"""
+    swap_status = swap_flight.result()
+    # The callback runs on the leader's thread, the job's own run goes back to the executor
+    cancel_processing_status(job_id)
+    if swap_status == 'completed':
+        # The swap result is in the result cache now, the job only downloads and uploads its own copy
+        job_executor.submit(run_swap_job, job_id, face_id, media_id)
+    elif swap_status == 'rejected':
+        # The same inputs would be turned down again
+        logger.info("Shared swap for job %s was rejected, failing the job without a retry", job_id)
+        try:
+            update_job_status(job_id, 'failed')
+        finally:
+            release_job(job_id)
+    else:
+        # The failure may have been transient, try the swap again
+        logger.info("Shared swap for job %s failed, running it on its own", job_id)
+        job_executor.submit(process_swap_job, job_id, face_id, media_id)
+
+def run_swap_job(job_id, face_id, media_id):
+    """Download the job media, run facefusion and upload the result, returning 'completed', 'rejected' for unusable inputs or None"""
     face_path = None
     media_path = None
     output_path = None
+    preview_path = None
 
-    try:
-        print(f"Fetching job document for {job_id}...")
-        job_doc = databases.get_document(
-            database_id=APPWRITE_DATABASE_ID,
-            collection_id=APPWRITE_JOBS_COLLECTION_ID,
-            document_id=job_id
-        )
-        face_id = job_doc.get('faceId')
-        media_id = job_doc.get('mediaId')
-
-        if not face_id or not media_id:
-            error_msg = "Missing faceId or mediaId in job document"
-            print(f"Error for job {job_id}: {error_msg}", file=sys.stderr)
-            update_job_status(job_id, 'failed')
-            return jsonify({"error": error_msg}), 400
-
-        print(f"  Job document found. Source ID: {face_id}, Target ID: {media_id}")
+    # Job IDs are unique, the start time keeps a retry clear of files the previous attempt is still deleting
+    file_prefix = f"{job_id}_{time.time_ns():x}"
 
-    except AppwriteException as e:
-        if e.code == 404:
-            error_msg = f"Job document not found: {job_id}"
-            print(error_msg, file=sys.stderr)
-            return jsonify({"error": error_msg}), 404
-        else:
-            error_msg = f"Appwrite error fetching job {job_id}: {e}"
-            print(error_msg, file=sys.stderr)
-            if hasattr(e, 'response') and e.response:
-                print(f"Appwrite Response (Fetch Error): {e.response}", file=sys.stderr)
-            return jsonify({"error": "Failed to fetch job details.", "details": str(e)}), 500
-    except Exception as e:
-        error_msg = f"Unexpected error fetching job {job_id}: {e}"
-        print(error_msg, file=sys.stderr)
-        traceback.print_exc()
-        return jsonify({"error": "Internal server error during job fetch."}), 500
+    logger.info("Processing job %s", job_id)
 
     try:
-        print("Fetching file metadata...")
-        try:
-            source_file_meta = storage.get_file(APPWRITE_SOURCE_BUCKET_ID, face_id)
-            target_file_meta = storage.get_file(APPWRITE_TARGET_BUCKET_ID, media_id)
-            source_filename_original = source_file_meta['name']
-            target_filename_original = target_file_meta['name']
-            print(f"  Source original name: {source_filename_original}")
-            print(f"  Target original name: {target_filename_original}")
-        except AppwriteException as e:
-            error_msg = f"Failed to get file metadata from Appwrite Storage. Error: {e}"
-            print(error_msg, file=sys.stderr)
-            if hasattr(e, 'response') and e.response:
-                print(f"Appwrite Response (Metadata Error): {e.response}", file=sys.stderr)
-            update_job_status(job_id, 'failed')
-            return jsonify({"error": "Failed to get media file details.", "details": str(e)}), 500
-
-        update_job_status(job_id, 'processing')
-
-        print("Downloading media files...")
-        source_ext = get_file_extension(source_filename_original)
-        target_ext = get_file_extension(target_filename_original)
-
-        source_filename_local = f"{job_id}_source_{uuid.uuid4().hex}{source_ext}"
-        target_filename_local = f"{job_id}_target_{uuid.uuid4().hex}{target_ext}"
-        face_path = SOURCE_DIR / source_filename_local
-        media_path = TARGET_DIR / target_filename_local
+        # Short jobs skip the round trip and go straight to their final status
+        schedule_processing_status(job_id)
 
         try:
-            print(f"  Downloading Source (Bucket: {APPWRITE_SOURCE_BUCKET_ID}, File: {face_id})")
-            source_bytes = storage.get_file_download(APPWRITE_SOURCE_BUCKET_ID, face_id)
-            with open(face_path, 'wb') as f: f.write(source_bytes)
-            print(f"    Downloaded source to: {face_path}")
-
-            print(f"  Downloading Target (Bucket: {APPWRITE_TARGET_BUCKET_ID}, File: {media_id})")
-            target_bytes = storage.get_file_download(APPWRITE_TARGET_BUCKET_ID, media_id)
-            with open(media_path, 'wb') as f: f.write(target_bytes)
-            print(f"    Downloaded target to: {media_path}")
-
-        except AppwriteException as e:
-            error_msg = f"Failed to download files from Appwrite Storage. Error: {e}"
-            print(error_msg, file=sys.stderr)
+            # Source and target are independent, resolve and download each side concurrently
+            logger.info("Fetching source %s and target %s", face_id, media_id)
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                source_future = executor.submit(fetch_file, APPWRITE_SOURCE_BUCKET_ID, face_id, SOURCE_DIR / f"{file_prefix}_source")
+                target_future = executor.submit(fetch_file, APPWRITE_TARGET_BUCKET_ID, media_id, TARGET_DIR / f"{file_prefix}_target")
+            # Both sides are done here, keep whichever file arrived for cleanup before raising
+            if not source_future.exception():
+                face_path, face_digest = source_future.result()
+            if not target_future.exception():
+                media_path, media_digest = target_future.result()
+            source_future.result()
+            target_future.result()
+            logger.info("Downloaded source to %s and target to %s", face_path, media_path)
+
+        except (AppwriteException, requests.RequestException) as e:
+            logger.error("Failed to fetch files from Appwrite Storage. Error: %s", e)
             if hasattr(e, 'response') and e.response:
-                print(f"Appwrite Response (Download Error): {e.response}", file=sys.stderr)
+                logger.error("Appwrite Response (Download Error): %s", e.response)
+            update_job_status(job_id, 'failed')
+            return
+        except MediaTooLargeError as e:
+            logger.error("Rejected media of job %s: %s", job_id, e)
             update_job_status(job_id, 'failed')
-            return jsonify({"error": "Failed to download media files.", "details": str(e)}), 500
+            return 'rejected'
         except Exception as e:
-             error_msg = f"Failed write downloaded files locally: {e}"
-             print(error_msg, file=sys.stderr)
+             logger.error("Failed write downloaded files locally: %s", e)
              update_job_status(job_id, 'failed')
-             return jsonify({"error": "Failed to save media files locally.", "details": str(e)}), 500
-
-        output_filename = f"result_{job_id}_{uuid.uuid4().hex}{target_ext}"
-        output_path = OUTPUT_DIR / output_filename
-
-        preview_path = None
-
-        command = [
-            sys.executable,
-            str(FACEFUSION_SCRIPT_PATH),
-            'headless-run',
-            '-s', str(face_path),
-            '-t', str(media_path),
-            '-o', str(output_path)
-            # Add any other necessary facefusion args here
-        ]
-
-        print(f"Executing command: {' '.join(command)}")
-        process = subprocess.run(
-            command,
-            capture_output=True,
-            text=True,
-            check=False,
-            encoding='utf-8'
-        )
+             return
+
+        # Results of spilled targets are written next to them on disk
+        output_dir = OUTPUT_DIR if media_path.parent == TARGET_DIR else SPILL_DIR / "output"
+        output_filename = f"{file_prefix}_result{media_path.suffix}"
+        output_path = output_dir / output_filename
+
+        # Identical inputs under the same facefusion settings give the same result, reuse it when cached
+        result_cache_dir = RESULT_CACHE_DIR / get_result_key(face_digest, media_digest)
+        cached_output_path, _ = link_cached_file(result_cache_dir, output_dir / f"{file_prefix}_result")
+        if cached_output_path:
+            logger.info("Reusing cached result for job %s", job_id)
+            output_path = cached_output_path
+            result = {'job_id': job_id, 'error_code': 0, 'error': None}
+        else:
+            logger.info("Running facefusion for job %s...", job_id)
+            result = run_facefusion(job_id, face_path, media_path, output_path)
+            if result['error_code'] == 0 and output_path.exists():
+                cache_file(output_path, result_cache_dir / f"result{output_path.suffix}")
 
         # --- Updated Handle Command Result ---
-        # Success check: return code 0 AND output file exists
-        if process.returncode == 0 and output_path.exists():
-            print("Face swapping process completed successfully (Return Code 0, Output File Exists).")
-            print(f"  stdout:\n{process.stdout}")
-
-            print(f"Uploading result file {output_path} to Appwrite Storage (Bucket: {APPWRITE_RESULT_BUCKET_ID})...")
+        # Success check: error code 0 AND output file exists
+        if result['error_code'] == 0 and output_path.exists():
+            logger.info("Face swapping process completed successfully (Error Code 0, Output File Exists).")
+            logger.info("Uploading result file %s to Appwrite Storage (Bucket: %s)...", output_path, APPWRITE_RESULT_BUCKET_ID)
             try:
-                input_file = InputFile.from_path(str(output_path))
-                upload_response = storage.create_file(
-                    bucket_id=APPWRITE_RESULT_BUCKET_ID,
-                    file_id=ID.unique(),
-                    file=input_file,
-                )
-                result_id = upload_response['$id']
-                print(f"  Upload successful. Result ID: {result_id}")
-                
-                # Check if the result is a video and create a GIF preview
-                preview_id = None
-
-                if is_video_file(output_path) and shutil.which('ffmpeg'):
-                    print("Video result detected. Creating GIF preview...")
-                    preview_path = OUTPUT_DIR / f"preview_{job_id}_{uuid.uuid4().hex}.gif"
-                    if create_gif_preview(output_path, preview_path):
-                        try:
-                            preview_input_file = InputFile.from_path(str(preview_path))
-                            preview_upload = storage.create_file(
-                                bucket_id=APPWRITE_RESULT_BUCKET_ID,
-                                file_id=ID.unique(),
-                                file=preview_input_file,
-                            )
-                            preview_id = preview_upload['$id']
-                            print(f"  GIF preview upload successful. Preview ID: {preview_id}")
-                            
-                            # Don't add to files_to_delete here - it's not in scope
-                        except Exception as e:
-                            print(f"Warning: Failed to upload GIF preview: {e}", file=sys.stderr)
-                    else:
-                        print("Warning: Failed to create GIF preview", file=sys.stderr)
-                
-                update_data = {'status': 'completed', 'resultId': result_id}
-                if preview_id:
-                    update_data['mediaPreviewId'] = preview_id
-                
-                # Update job with result ID and optional preview ID
-                databases.update_document(
-                    database_id=APPWRITE_DATABASE_ID,
-                    collection_id=APPWRITE_JOBS_COLLECTION_ID,
-                    document_id=job_id,
-                    data=update_data
-                )
-                
-                return jsonify({ "status": "success", "jobId": job_id, "resultId": result_id, "previewId": preview_id }), 200
+                # Generate and upload the preview while the result upload is in flight
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    preview_future = None
+
+                    if is_video_file(output_path) and get_preview_encoder():
+                        logger.info("Video result detected. Creating preview...")
+                        preview_path = output_dir / f"{file_prefix}_preview.mp4"
+                        preview_future = executor.submit(upload_preview, output_path, preview_path)
+
+                    result_id = upload_file(APPWRITE_RESULT_BUCKET_ID, output_path)
+                    logger.info("Upload successful. Result ID: %s", result_id)
+
+                    preview_id = preview_future.result() if preview_future else None
 
             except AppwriteException as e:
-                error_msg = f"Failed to upload result file to Appwrite Storage. Error: {e}"
-                print(error_msg, file=sys.stderr)
+                logger.error("Failed to upload result file to Appwrite Storage. Error: %s", e)
                 if hasattr(e, 'response') and e.response:
-                    print(f"Appwrite Response (Upload Error): {e.response}", file=sys.stderr)
+                    logger.error("Appwrite Response (Upload Error): %s", e.response)
                 update_job_status(job_id, 'failed')
-                return jsonify({"error": "Failed to upload result file.", "details": str(e)}), 500
+                return
             except Exception as e:
-                error_msg = f"Unexpected error during result upload: {e}"
-                print(error_msg, file=sys.stderr)
+                logger.error("Unexpected error during result upload: %s", e)
                 update_job_status(job_id, 'failed')
-                return jsonify({"error": "Failed to upload result file.", "details": str(e)}), 500
+                return
+
+            # Status, result ID and optional preview ID land in one terminal write
+            update_job_status(job_id, 'completed', result_id, preview_id)
+            logger.info("Job %s completed. Result ID: %s", job_id, result_id)
+            return 'completed'
 
         else:
             # Handle command failure based on return code or missing output file
             error_msg = f"Face swapping process failed."
             details = []
-            if process.returncode != 0:
-                details.append(f"Return code: {process.returncode}")
+            if result['error_code'] != 0:
+                details.append(f"Error code: {result['error_code']}")
             if not output_path.exists():
                 # This check is important if the process might return 0 but still fail to create the file
                 details.append("Output file not created.")
@@ -335,38 +757,118 @@ def swap_faces_endpoint():
                 # Should ideally not happen if the condition above failed, but as a fallback
                 error_msg += " (Unknown reason)"
 
-            print(error_msg, file=sys.stderr)
-
-            stderr_output = process.stderr or "No stderr output."
-            stdout_output = process.stdout or "No stdout output." # Log stdout even on failure
-            print(f"  stderr:\n{stderr_output}", file=sys.stderr)
-            print(f"  stdout:\n{stdout_output}", file=sys.stderr)
+            # Facefusion logs to the worker console, only the error summary comes back
+            error_output = result['error'] or "See facefusion worker output."
+            logger.error("%s\n  error:\n%s", error_msg, error_output)
 
             update_job_status(job_id, 'failed')
-            return jsonify({ "status": "error", "jobId": job_id, "message": error_msg, "details": stderr_output }), 500
+            # Facefusion ran through and turned the inputs down, e.g. no face found. Crashes,
+            # timeouts, exceptions and failed pre-checks all come back with an error or another code.
+            if result['error_code'] == 1 and not result['error']:
+                return 'rejected'
 
     except Exception as e:
-        error_msg = f"An unexpected error occurred during job {job_id} processing: {e}"
-        print(error_msg, file=sys.stderr)
-        traceback.print_exc()
+        logger.exception("An unexpected error occurred during job %s processing: %s", job_id, e)
         update_job_status(job_id, 'failed')
-        return jsonify({"error": "An internal server error occurred during processing."}), 500
 
     finally:
-        print(f"Cleaning up local files for job {job_id}...")
-        files_to_delete = [face_path, media_path, output_path]
-        # Add preview_path to cleanup list if it was created
-        if 'preview_path' in locals() and preview_path and preview_path.exists():
-            files_to_delete.append(preview_path)
-        for file_path in files_to_delete:
-             if file_path and file_path.exists():
-                try:
-                    file_path.unlink()
-                    print(f"  Deleted {file_path}")
-                except OSError as e:
-                     print(f"Warning: Error deleting file {file_path}: {e}", file=sys.stderr)
-        print(f"--- Job {job_id} processing finished ---")
+        cancel_processing_status(job_id)
+        cleanup_executor.submit(delete_files, [face_path, media_path, output_path, preview_path])
+        release_job(job_id)
+        logger.info("Job %s processing finished", job_id)
+
+class SwapRequest(BaseModel):
+    """Payload of the swap endpoint, missing fields are left to the secret and jobId checks so they keep their 401 and 400"""
+    secret: str | None = None
+    jobId: str | None = None
+
+def require_secret(payload_model):
+    """Parse the JSON payload into payload_model and reject it unless it carries the endpoint secret"""
+    def decorator(view):
+        @functools.wraps(view)
+        def decorated_view(*args, **kwargs):
+            # Parsing and type checks happen in one pass over the raw body
+            try:
+                payload = payload_model.model_validate_json(request.get_data())
+            except ValidationError:
+                return jsonify({"error": "Invalid JSON payload"}), 400
+
+            if not payload.secret or not compare_digest(payload.secret.encode('utf-8'), ENDPOINT_SECRET_BYTES):
+                logger.warning("Unauthorized access attempt: Invalid secret")
+                return jsonify({"error": "Unauthorized"}), 401
+            return view(payload, *args, **kwargs)
+        return decorated_view
+    return decorator
+
+@app.route('/v1/swap-faces', methods=['POST'])
+@require_secret(SwapRequest)
+def swap_faces_endpoint(payload):
+    job_id = payload.jobId
+    if not job_id:
+        return jsonify({"error": "Missing 'jobId' parameter"}), 400
+    if not is_appwrite_id(job_id):
+        return jsonify({"error": "Invalid 'jobId' parameter"}), 400
+
+    logger.info("Received job request: %s", job_id)
+
+    # Retries of a job that is still in flight are answered before any Appwrite call
+    if not claim_job(job_id):
+        logger.info("Job %s is already in flight, not queueing it again", job_id)
+        return jsonify({"status": "processing", "jobId": job_id}), 202
+
+    job_queued = False
+    try:
+        try:
+            job_doc = get_job_document(job_id)
+            face_id = job_doc.get('faceId')
+            media_id = job_doc.get('mediaId')
+
+            if not face_id or not media_id:
+                error_msg = "Missing faceId or mediaId in job document"
+                logger.error("Error for job %s: %s", job_id, error_msg)
+                update_job_status(job_id, 'failed')
+                return jsonify({"error": error_msg}), 400
+
+            if not is_appwrite_id(face_id) or not is_appwrite_id(media_id):
+                error_msg = "Invalid faceId or mediaId in job document"
+                logger.error("Error for job %s: %s", job_id, error_msg)
+                update_job_status(job_id, 'failed')
+                return jsonify({"error": error_msg}), 400
+
+            logger.info("Job document found. Source ID: %s, Target ID: %s", face_id, media_id)
+
+        except AppwriteException as e:
+            if e.code == 404:
+                error_msg = f"Job document not found: {job_id}"
+                logger.error(error_msg)
+                return jsonify({"error": error_msg}), 404
+            else:
+                logger.error("Appwrite error fetching job %s: %s", job_id, e)
+                if hasattr(e, 'response') and e.response:
+                    logger.error("Appwrite Response (Fetch Error): %s", e.response)
+                return jsonify({"error": "Failed to fetch job details.", "details": str(e)}), 500
+        except Exception as e:
+            logger.exception("Unexpected error fetching job %s: %s", job_id, e)
+            return jsonify({"error": "Internal server error during job fetch."}), 500
+
+        if job_doc.get('status') == 'processing':
+            logger.info("Job %s is already processing, not queueing it again", job_id)
+            return jsonify({"status": "processing", "jobId": job_id}), 202
+
+        # The swap takes seconds to minutes, clients poll the job document for the outcome
+        job_executor.submit(process_swap_job, job_id, face_id, media_id)
+        job_queued = True
+        logger.info("Job %s queued", job_id)
+        return jsonify({"status": "queued", "jobId": job_id}), 202
+    finally:
+        # Once queued the job releases itself when it finishes
+        if not job_queued:
+            release_job(job_id)
 
 if __name__ == '__main__':
-    print(f"Starting Flask server on {FLASK_HOST}:{FLASK_PORT}")
+    # Production runs under gunicorn (see gunicorn.conf.py), the Werkzeug server is for development only
+    if not os.getenv('DEV'):
+        logger.error("Serve the API with 'gunicorn web:app', or set DEV=1 to use the Flask development server.")
+        sys.exit(1)
+    logger.info("Starting Flask development server on %s:%s", FLASK_HOST, FLASK_PORT)
     app.run(host=FLASK_HOST, port=FLASK_PORT, debug=False)
@@ -0,0 +1,86 @@
+import math
+import os
+import time
+import traceback
+
+# Seconds between progress messages sent to the web process
+PROGRESS_INTERVAL = 1.0
+
+
+def run_worker(job_queue, result_queue):
+    """Run swap jobs from job_queue, importing facefusion once for the lifetime of the process"""
+    os.environ['OMP_NUM_THREADS'] = '1'
+
+    # Imported here so only the worker process pays for facefusion and its models
+    from facefusion import config, content_analyser, core, face_classifier, face_detector, face_landmarker, face_masker, face_recognizer, logger, state_manager
+    from facefusion.args import apply_args, reduce_step_args
+    from facefusion.face_store import clear_static_faces
+    from facefusion.jobs import job_manager, job_runner
+    from facefusion.processors.core import get_processors_modules
+    from facefusion.program import create_program
+    from tqdm import tqdm
+
+    # Forward facefusion's tqdm progress to the web process, the same hook the UI terminal uses
+    tqdm_update = tqdm.update
+    progress_state = {'job_id': None, 'time': 0.0}
+
+    def report_progress(self, n=1):
+        tqdm_update(self, n)
+        if not progress_state['job_id'] or not self.desc or not self.total:
+            return
+        now = time.monotonic()
+        if self.n < self.total and now - progress_state['time'] < PROGRESS_INTERVAL:
+            return
+        progress_state['time'] = now
+        result_queue.put({'job_id': progress_state['job_id'], 'stage': self.desc, 'progress': math.floor(self.n / self.total * 100)})
+
+    tqdm.update = report_progress
+
+    # Resolve the headless-run defaults and facefusion.ini once, jobs only swap in their paths
+    program = create_program()
+    default_args = vars(program.parse_args(['headless-run']))
+    # facefusion defaults to 'strict', which drops every ONNX session after each job
+    if not config.get_str_value('memory.video_memory_strategy'):
+        default_args['video_memory_strategy'] = 'tolerant'
+    apply_args(default_args, state_manager.init_item)
+    logger.init(state_manager.get_item('log_level'))
+    is_ready = core.pre_check() and job_manager.init_jobs(state_manager.get_item('jobs_path'))
+
+    # Download, verify and load the models before the first job instead of during it
+    if is_ready and core.common_pre_check() and core.processors_pre_check():
+        for module in [content_analyser, face_classifier, face_detector, face_landmarker, face_masker, face_recognizer, *get_processors_modules(state_manager.get_item('processors'))]:
+            module.get_inference_pool()
+
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+
+        result = {'job_id': job['job_id'], 'error_code': 1, 'error': None}
+        if not is_ready:
+            result['error_code'] = 2
+            result['error'] = "Facefusion pre-check failed."
+            result_queue.put(result)
+            continue
+        progress_state['job_id'] = job['job_id']
+        # process_headless names jobs by the second, back to back jobs and other workers sharing the jobs path would collide
+        facefusion_job_id = f"{job['job_id']}-{time.time_ns()}"
+        try:
+            step_args = reduce_step_args({
+                **default_args,
+                'source_paths': [job['source_path']],
+                'target_path': job['target_path'],
+                'output_path': job['output_path']
+            })
+            is_processed = job_manager.create_job(facefusion_job_id) and job_manager.add_step(facefusion_job_id, step_args) and job_manager.submit_job(facefusion_job_id) and job_runner.run_job(facefusion_job_id, core.process_step)
+            result['error_code'] = 0 if is_processed else 1
+        except (Exception, SystemExit):
+            # facefusion helpers may hard_exit, keep the worker alive regardless.
+            # The traceback goes to the web process, which logs it with the job.
+            result['error'] = traceback.format_exc().rstrip()
+        # The outcome travels back in the result, the job file would only pile up under the jobs path
+        job_manager.delete_job(facefusion_job_id)
+        progress_state['job_id'] = None
+        # Detections are keyed by frame hash and never expire on their own
+        clear_static_faces()
+        result_queue.put(result)